@@ -0,0 +1,264 @@
+"""
+Patch-feature anomaly detection on the MobileNetV2 backbone (PatchCore style).
+
+Intermediate feature maps of the good samples of each texture are stored as
+patch features in a memory bank. The bank is reduced with greedy coreset
+subsampling, so memory stays bounded, and new patches are scored by their
+nearest-neighbour distance to the bank. The search is a blocked matrix
+multiply, so it runs fast on the CPU without an external index.
+
+NOTE: The dataset has no defect classes. Classes with "_" are the colourised
+renders of `simulation.build_images`, ie. "0044_red", so by default the
+evaluation below measures how well colour shifts are detected. Which classes
+are good and which are anomalous is passed explicitly to `evaluate_auroc`.
+"""
+import sys
+sys.path.append(".")
+
+import time
+from pathlib import Path
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+from transformers.models.mobilenet_v2 import MobileNetV2ForImageClassification
+from sklearn.metrics import roc_auc_score
+from tqdm import tqdm
+
+from classify.train import *
+
+
+def greedy_coreset(
+    features: torch.Tensor,
+    n_select: int,
+    projection_dim: int = 128,
+    seed: int = 42,
+) -> torch.Tensor:
+    """
+    Indices of `n_select` rows of `features` (NxD) chosen by greedy farthest point
+    sampling, such that every feature is close to one of the selected ones.
+    Distances are computed on a random projection to speed up the selection.
+    """
+    n, d = features.shape
+    if n_select >= n:
+        return torch.arange(n)
+
+    generator = torch.Generator().manual_seed(seed)
+    if projection_dim < d:
+        projection = torch.randn(d, projection_dim, generator=generator) / projection_dim**0.5
+        z = features.float() @ projection.to(features.device)  # NxP
+    else:
+        z = features.float()
+
+    selected = torch.empty(n_select, dtype=torch.long)
+    idx = int(torch.randint(n, (1,), generator=generator))
+    min_dists = torch.full((n,), float("inf"), device=z.device)
+    for k in range(n_select):
+        selected[k] = idx
+        dists = (z - z[idx]).pow(2).sum(dim=1)  # N,
+        min_dists = torch.minimum(min_dists, dists)
+        idx = int(torch.argmax(min_dists))
+    return selected
+
+
+def nearest_neighbour_distances(
+    queries: torch.Tensor,
+    bank: torch.Tensor,
+    query_block: int = 4096,
+    bank_block: int = 16384,
+) -> torch.Tensor:
+    """
+    Euclidean distance (N,) of each query (NxD) to its nearest neighbour in the
+    bank (MxD), computed blockwise as |q|^2 + |b|^2 - 2 q.b so that at most
+    `query_block` x `bank_block` distances are held in memory.
+    """
+    bank_sq = bank.pow(2).sum(dim=1)  # M,
+    out = torch.empty(len(queries), device=queries.device)
+    for i in range(0, len(queries), query_block):
+        q = queries[i:i+query_block]
+        q_sq = q.pow(2).sum(dim=1, keepdim=True)  # Bx1
+        best = torch.full((len(q),), float("inf"), device=queries.device)
+        for j in range(0, len(bank), bank_block):
+            b = bank[j:j+bank_block]
+            d = q_sq + bank_sq[j:j+bank_block] - 2 * q @ b.T  # BxM'
+            best = torch.minimum(best, d.min(dim=1).values)
+        out[i:i+query_block] = best
+    return out.clamp_(min=0).sqrt_()
+
+
+class PatchCore:
+    """
+    Memory bank of backbone patch features per texture.
+
+    `layers` index the hidden states of the MobileNetV2 blocks, the defaults
+    are the last blocks at stride 8 (32 channels) and stride 16 (96 channels),
+    ie. 16x16 patch features for 128px inputs.
+    """
+
+    def __init__(
+        self,
+        model: MobileNetV2ForImageClassification,
+        layers: tuple[int, ...] = (4, 11),
+        coreset_ratio: float = 0.1,
+        max_bank_size: int = 20000,
+    ):
+        self.model = model.eval()
+        self.layers = tuple(layers)
+        self.coreset_ratio = coreset_ratio
+        self.max_bank_size = max_bank_size
+        self.banks: dict[str, torch.Tensor] = {}
+
+    @property
+    def device(self) -> torch.device:
+        return next(self.model.parameters()).device
+
+    @torch.inference_mode()
+    def embed(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        """Patch features BxDxhxw of a normalized BxCxHxW batch."""
+        output = self.model.mobilenet_v2(pixel_values.to(self.device), output_hidden_states=True)
+        maps = [output.hidden_states[i] for i in self.layers]
+        size = maps[0].shape[-2:]  # Resolution of the shallowest layer.
+        maps = [F.avg_pool2d(m, kernel_size=3, stride=1, padding=1) for m in maps]  # Local neighbourhood.
+        maps = [m if m.shape[-2:] == size else F.interpolate(m, size=size, mode="bilinear") for m in maps]
+        return torch.cat(maps, dim=1).float()
+
+    def fit(self, texture: str, dl: DataLoader):
+        """Build the memory bank of `texture` from the good samples in `dl`."""
+        features = []
+        for batch in tqdm(dl, desc=f"Fitting {texture}..."):
+            z = self.embed(batch["pixel_values"])  # BxDxhxw
+            features.append(z.permute(0, 2, 3, 1).reshape(-1, z.shape[1]).cpu())  # (B*h*w)xD
+        features = torch.cat(features, dim=0)
+
+        n_select = min(int(len(features) * self.coreset_ratio), self.max_bank_size)
+        indices = greedy_coreset(features.to(self.device), max(n_select, 1))
+        self.banks[texture] = features[indices].contiguous()
+
+    @torch.inference_mode()
+    def score(self, texture: str, pixel_values: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        Anomaly scores of a batch against the bank of `texture`, returns the
+        image scores (B,), the max over patches, and the patch score maps (Bxhxw).
+        """
+        z = self.embed(pixel_values)  # BxDxhxw
+        b, d, h, w = z.shape
+        queries = z.permute(0, 2, 3, 1).reshape(-1, d)
+        dists = nearest_neighbour_distances(queries, self.banks[texture].to(queries.device))
+        maps = dists.reshape(b, h, w).cpu()
+        return maps.flatten(1).max(dim=1).values, maps
+
+    def save(self, path: str):
+        torch.save({
+            "layers": self.layers,
+            "coreset_ratio": self.coreset_ratio,
+            "max_bank_size": self.max_bank_size,
+            "banks": self.banks,
+        }, path)
+
+    @classmethod
+    def load(cls, path: str, model: MobileNetV2ForImageClassification) -> "PatchCore":
+        state = torch.load(path, map_location="cpu")
+        patchcore = cls(model, state["layers"], state["coreset_ratio"], state["max_bank_size"])
+        patchcore.banks = state["banks"]
+        return patchcore
+
+
+def evaluate_auroc(
+    patchcore: PatchCore,
+    ds,
+    transforms: Transforms,
+    texture: str,
+    anomalous: list[str],
+    batch_size: int = 64,
+) -> float:
+    """
+    AUROC of separating the test patches of the fitted `texture` (good) from the
+    patches of the `anomalous` classes, scored against the bank of `texture`.
+    """
+    names = ds.features["label"].names
+    good_id = names.index(texture)
+    ids = [good_id] + [names.index(name) for name in anomalous]
+
+    ds = ds.filter(lambda label: label in ids, input_columns="label")
+    ds = ds.with_transform(transforms.apply_transforms)
+
+    scores, targets = [], []
+    for batch in DataLoader(ds, batch_size=batch_size):
+        s, _ = patchcore.score(texture, batch["pixel_values"])
+        scores.append(s.numpy())
+        targets.append((batch["label"] != good_id).numpy())
+    return float(roc_auc_score(np.concatenate(targets), np.concatenate(scores)))
+
+
+def benchmark_scoring(
+    bank_sizes: tuple[int, ...] = (1000, 5000, 20000, 50000),
+    n_queries: int = 256 * 16 * 16,  # One batch of 256 patches at 16x16 locations.
+    dim: int = 128,
+    n_repeats: int = 3,
+) -> list[dict]:
+    """CPU latency of the nearest-neighbour search against the bank size, on random features."""
+    queries = torch.randn(n_queries, dim)
+    results = []
+    for bank_size in bank_sizes:
+        bank = torch.randn(bank_size, dim)
+        nearest_neighbour_distances(queries[:1024], bank)  # Warmup.
+
+        start = time.perf_counter()
+        for _ in range(n_repeats):
+            nearest_neighbour_distances(queries, bank)
+        elapsed = (time.perf_counter() - start) / n_repeats
+
+        result = {
+            "bank_size": bank_size,
+            "n_queries": n_queries,
+            "ms": 1000 * elapsed,
+            "queries_per_sec": n_queries / elapsed,
+        }
+        print(result)
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    root = r"C:\Users\lbrunn\projects\surface-inspection\datasets\wood"
+    size = 128
+    mean = 0.5
+    std = 0.5
+    pretrained_model_name_or_path = r"C:\Users\lbrunn\projects\surface-inspection\classify\logs\checkpoint-1350"
+    output_path = Path(r"C:\Users\lbrunn\projects\surface-inspection\anomaly\patchcore.pt")
+    batch_size = 64
+    benchmark = False
+    textures = ["0044", "0007"]  # Good samples, one memory bank each.
+    colors = ["red", "green", "blue", "yellow", "purple", "orange", "pink"]  # See simulation.py.
+    anomalous = {texture: [f"{texture}_{color}" for color in colors] for texture in textures}  # Colour shifts.
+
+    if benchmark:
+        benchmark_scoring()
+        sys.exit()
+
+    test_transforms = Transforms(Compose([
+        CenterCrop(size),
+        ToTensor(),
+        Normalize(mean, std),
+    ]))
+
+    loaded = load_dataset("imagefolder", data_dir=root)
+    train_ds = loaded["train"]
+    test_ds = loaded["test"]
+    names = train_ds.features["label"].names
+
+    model: MobileNetV2ForImageClassification = AutoModelForImageClassification.from_pretrained(
+        pretrained_model_name_or_path,
+    ).eval()
+    patchcore = PatchCore(model)
+
+    for texture in textures:
+        i = names.index(texture)
+        ds = train_ds.filter(lambda label: label == i, input_columns="label")
+        ds = ds.with_transform(test_transforms.apply_transforms)
+        patchcore.fit(texture, DataLoader(ds, batch_size=batch_size))
+
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    patchcore.save(output_path)
+
+    for texture in textures:
+        auroc = evaluate_auroc(patchcore, test_ds, test_transforms, texture, anomalous[texture], batch_size)
+        print(texture, "colour-shift AUROC:", auroc)
@@ -1,5 +1,12 @@
+import sys
+sys.path.append("..")
+
+import atexit
 import base64
-from flask import Flask, jsonify
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from flask import Flask, jsonify, request
 from flask_cors import CORS
 from torch.utils.data import DataLoader, Subset
 from dataclasses import dataclass
@@ -10,7 +17,7 @@ from PIL.PngImagePlugin import PngImageFile
 import matplotlib
 matplotlib.use("Agg")  # Non-GUI backend!
 
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import io
 import numpy as np
 import torch
@@ -20,20 +27,31 @@ from torchvision.transforms import (
     Normalize,
     ToTensor,
 )
-from transformers import AutoModelForImageClassification
 from transformers.models.mobilenet_v2 import MobileNetV2ForImageClassification
 from sklearn.metrics import confusion_matrix, ConfusionMatrixDisplay
 
+from classify.embedding_index import EmbeddingIndex
+from results_store import Judgement, ResultsStore
+from model_registry import ModelRegistry
+
 
 @dataclass
 class Config:
     dataset_path: str = ""
     dataset_split: str = "test"
     labels: tuple[str] = ("", "")
-    pretrained_model_name_or_path: str = ""
+    pretrained_model_name_or_path: str = ""  # The "default" model.
+    models_dir: str = ""  # Optional folder with "checkpoint-*" models to choose from per request.
+    max_models: int = 2  # Models kept in memory at once.
+    max_model_bytes: int = 0  # Limit for the weights held by the registry, 0 for no limit.
+    device: str = "cuda"  # Device the models run on, ie. "cpu".
     image_size: int = 128
     image_mean: float = 0.5
     image_std: float = 0.5
+    embedding_index_path: str = ""  # Optional, see classify/embedding_index.py.
+    evaluation_workers: int = 1  # Background threads for evaluation jobs.
+    results_path: str = "results.sqlite"  # Human vs. model judgements of all sessions.
+    results_flush_size: int = 1  # Judgements buffered before they are written, 1 commits each one.
     
 
 def load_imagefolder(config: Config):
@@ -75,7 +93,8 @@ def predict(
     transformed_images = []
     for img in images:
         transformed_images.append(transforms(img.convert("RGB")))  # CxHxW
-    transformed_images = torch.stack(transformed_images, dim=0).cuda()  # BxCxHxW
+    device = next(model.parameters()).device
+    transformed_images = torch.stack(transformed_images, dim=0).to(device)  # BxCxHxW
     
     predictions = torch.argmax(model(transformed_images).logits, dim=1).cpu().numpy()  # B,
     return predictions
@@ -86,11 +105,11 @@ def get_confusion_matrix_base64(tgts: np.ndarray, preds: np.ndarray):
     names = [id2label[str(label)] for label in classes]
     cm = confusion_matrix(tgts, preds, labels=classes)
     disp = ConfusionMatrixDisplay(confusion_matrix=cm, display_labels=names)
-    disp.plot(xticks_rotation="vertical")
+    fig = Figure()  # No pyplot, its global state is not thread-safe.
+    disp.plot(ax=fig.subplots(), xticks_rotation="vertical")
 
     buf = io.BytesIO()
-    plt.savefig(buf, format="png", bbox_inches="tight")
-    plt.close()
+    fig.savefig(buf, format="png", bbox_inches="tight")
     buf.seek(0)
     encoded_image = base64.b64encode(buf.getvalue()).decode("utf-8")
     
@@ -133,9 +152,37 @@ test_transforms = Compose([
     Normalize(config.image_mean, config.image_std),
 ])
 
-model: MobileNetV2ForImageClassification = AutoModelForImageClassification.from_pretrained(
+model_registry = ModelRegistry(
     config.pretrained_model_name_or_path,
-).eval().cuda()
+    models_dir=config.models_dir,
+    max_models=config.max_models,
+    max_bytes=config.max_model_bytes,
+    device=config.device,
+    image_size=config.image_size,
+)
+model_registry.get("default")  # Load and warm up the default model at startup.
+
+evaluation_executor = ThreadPoolExecutor(
+    max_workers=config.evaluation_workers,
+    thread_name_prefix="evaluation",
+)
+evaluation_lock = threading.Lock()
+# Only the latest job per model is kept, superseded jobs are dropped when a new one is submitted.
+evaluation_jobs: dict[str, Future] = {}  # Job id -> running or finished evaluation.
+evaluation_cache: dict[str, tuple[int, str]] = {}  # Model -> (number of seen items, job id).
+
+judgement_executor = ThreadPoolExecutor(  # Separate, so judgements never wait behind evaluations.
+    max_workers=1,
+    thread_name_prefix="judgement",
+)
+
+session = uuid.uuid4().hex  # One annotation session per backend run.
+results_store = ResultsStore(config.results_path, config.results_flush_size)
+atexit.register(results_store.close)
+
+embedding_index = None
+if config.embedding_index_path:
+    embedding_index = EmbeddingIndex(config.embedding_index_path)
 
 app = Flask(__name__)
 CORS(app)
@@ -187,18 +234,141 @@ def get_next():
     return jsonify(data)
 
 
-@app.route('/api/evaluation', methods=['GET'])
-def get_eval():
-    if len(seen_pil_images) > 0:
-        preds = predict(seen_pil_images, model, test_transforms)
-        tgts = np.asarray(seen_integer_labels)
+def evaluate(model_name: str, images: list[PngImageFile], integer_labels: list[int]) -> dict:
+    if len(images) > 0:
+        preds = predict(images, model_registry.get(model_name), test_transforms)
+        tgts = np.asarray(integer_labels)
         acc = f"{100 * (preds == tgts).sum() / len(preds):.2f}"
         image_base64 = get_confusion_matrix_base64(tgts, preds)
     else:
         acc = ""
         image_base64 = ""
 
-    data = {"acc": acc, "image_base64": image_base64}
+    return {"acc": acc, "image_base64": image_base64, "model": model_name}
+
+
+@app.route('/api/evaluation', methods=['POST'])
+def start_eval():
+    """
+    Start an evaluation of all items seen so far in the background and
+    return its job id, poll /api/evaluation/<job_id> for the result.
+    The seen items only ever grow, so their number identifies the seen set
+    and repeated requests reuse the job (and result) of the same set.
+    A new job replaces the previous one of the same model, whose id is then unknown.
+    Choose the model with ?model=checkpoint-1350, see /api/models.
+    """
+    model_name = request.args.get("model", "default")
+    if model_name not in model_registry.available():
+        return jsonify({"error": f"Unknown model: {model_name}"}), 404
+
+    with evaluation_lock:
+        n = len(seen_integer_labels)
+        cached_n, job_id = evaluation_cache.get(model_name, (None, None))
+        future = evaluation_jobs.get(job_id)
+        failed = future is not None and future.done() and future.exception() is not None
+        if cached_n != n or future is None or failed:  # New seen set or retry of a failed job.
+            if future is not None:  # Superseded.
+                future.cancel()  # Only has an effect if it did not start yet.
+                del evaluation_jobs[job_id]
+            job_id = uuid.uuid4().hex
+            evaluation_jobs[job_id] = evaluation_executor.submit(
+                evaluate, model_name, seen_pil_images[:n], seen_integer_labels[:n],
+            )
+            evaluation_cache[model_name] = (n, job_id)
+
+    return jsonify({"job_id": job_id}), 202
+
+
+@app.route('/api/evaluation/<job_id>', methods=['GET'])
+def get_eval(job_id: str):
+    with evaluation_lock:
+        future = evaluation_jobs.get(job_id)
+
+    if future is None or future.cancelled():  # Cancelled jobs were superseded and dropped.
+        return jsonify({"job_id": job_id, "status": "unknown"}), 404
+
+    if not future.done():
+        status = "running" if future.running() else "pending"
+        return jsonify({"job_id": job_id, "status": status})
+
+    if future.exception() is not None:
+        return jsonify({"job_id": job_id, "status": "failed", "error": str(future.exception())}), 500
+
+    return jsonify({"job_id": job_id, "status": "done", **future.result()})
+
+
+def record_judgement(item: int, human: str, model_name: str):
+    image = seen_pil_images[item - 1]
+    target = id2label[str(seen_integer_labels[item - 1])]
+    model = model_registry.get(model_name)
+    model_label = id2label[str(predict([image], model, test_transforms)[0])]
+    results_store.add(Judgement(session, item, target, human, model_label, model_name))
+
+
+def log_judgement_failure(future: Future):
+    if future.exception() is not None:
+        app.logger.error("Failed to record judgement.", exc_info=future.exception())
+
+
+@app.route('/api/judgement', methods=['POST'])
+def post_judgement():
+    """
+    Record the label an annotator chose for a seen item, ie. {"n_seen": "3", "label": "0044"}.
+    The model prediction for the item is computed and stored in the background,
+    an optional "model" selects the model as in /api/models.
+    """
+    data = request.get_json()
+    item = int(data["n_seen"])
+    if not 0 < item <= len(seen_integer_labels):
+        return jsonify({"error": f"Item {item} was not seen yet."}), 400
+
+    model_name = data.get("model", "default")
+    if model_name not in model_registry.available():
+        return jsonify({"error": f"Unknown model: {model_name}"}), 404
+
+    future = judgement_executor.submit(record_judgement, item, data["label"], model_name)
+    future.add_done_callback(log_judgement_failure)
+    return jsonify({"session": session}), 202
+
+
+@app.route('/api/stats', methods=['GET'])
+def get_stats():
+    """
+    Human vs. model statistics over all sessions and of the current one, visit:
+    http://localhost:5000/api/stats
+    """
+    data = results_store.stats()
+    data["session"] = results_store.session_stats(session)
+    return jsonify(data)
+
+
+@app.route('/api/models', methods=['GET'])
+def get_models():
+    """
+    Models to choose from and the ones currently in memory, visit:
+    http://localhost:5000/api/models
+    """
+    data = {
+        "available": model_registry.available(),
+        "resident": model_registry.resident(),  # Name -> bytes, least recently used first.
+    }
+    return jsonify(data)
+
+
+@app.route('/api/similar/<label>', methods=['GET'])
+def get_similar(label: str):
+    """
+    Textures which look most like `label` according to the embedding index, visit:
+    http://localhost:5000/api/similar/0044
+    """
+    if embedding_index is None or label not in embedding_index.names:
+        return jsonify({"label": label, "similar": []})
+
+    similar = embedding_index.similar_classes(label, k=10)
+    data = {
+        "label": label,
+        "similar": [{"label": name, "score": f"{score:.4f}"} for name, score in similar],
+    }
     return jsonify(data)
 
 
@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:  # torch and transformers are only imported when a model is loaded.
+    import torch
+    from transformers.models.mobilenet_v2 import MobileNetV2ForImageClassification
+
+
+def checkpoint_sort_key(name: str) -> tuple[int, int, str]:
+    """Numbered checkpoints in numeric order ("checkpoint-900" < "checkpoint-1350"), then named ones."""
+    suffix = name.split("-")[-1]
+    return (0, int(suffix), "") if suffix.isdigit() else (1, 0, suffix)
+
+
+def model_bytes(model: torch.nn.Module) -> int:
+    """Memory held by the parameters and buffers of a model."""
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class ModelRegistry:
+    """
+    Loads classification checkpoints on demand and keeps at most `max_models`
+    of them (and at most `max_bytes` of weights, if > 0) resident, evicting
+    the least recently used one. Each model runs a warmup forward pass after
+    loading, so the first real request does not pay for lazy initialization.
+
+    Models are addressed by name, the default model by "default" and the
+    "checkpoint-*" folders (as written by classify/train.py) in `models_dir`
+    by their folder name. Arbitrary paths are not accepted.
+
+    NOTE: `max_bytes` only counts the models held by the registry. A model
+    that is evicted while a request still uses it stays in memory until that
+    request finishes, so the peak can briefly exceed the limit.
+    """
+
+    def __init__(
+        self,
+        default_path: str,
+        models_dir: str = "",
+        max_models: int = 2,
+        max_bytes: int = 0,
+        device: str = "cuda",
+        image_size: int = 128,
+    ):
+        self.default_path = default_path
+        self.models_dir = Path(models_dir) if models_dir else None
+        self.max_models = max(1, max_models)
+        self.max_bytes = max_bytes
+        self.device = device
+        self.image_size = image_size
+        self.models: OrderedDict[str, MobileNetV2ForImageClassification] = OrderedDict()
+        self.sizes: dict[str, int] = {}
+        self.loading: dict[str, Future] = {}  # Name -> model being loaded.
+        self.lock = threading.Lock()  # Guards the dicts only, never held while loading.
+
+    def available(self) -> list[str]:
+        names = ["default"]
+        if self.models_dir is not None and self.models_dir.exists():
+            names += sorted(
+                (p.name for p in self.models_dir.glob("checkpoint-*") if p.is_dir()),
+                key=checkpoint_sort_key,
+            )
+        return names
+
+    def resident(self) -> dict[str, int]:
+        """Names of the loaded models (least recently used first) and their size in bytes."""
+        with self.lock:
+            return {name: self.sizes[name] for name in self.models}
+
+    def path(self, name: str) -> str:
+        if name == "default":
+            return self.default_path
+        if name not in self.available():
+            raise KeyError(f"Unknown model: {name}")
+        return str(self.models_dir / name)
+
+    def load(self, name: str) -> MobileNetV2ForImageClassification:
+        import torch
+        from transformers import AutoModelForImageClassification
+
+        model: MobileNetV2ForImageClassification = AutoModelForImageClassification.from_pretrained(
+            self.path(name),
+        ).eval().to(self.device)
+        with torch.inference_mode():  # Warmup.
+            model(torch.zeros(1, 3, self.image_size, self.image_size, device=self.device))
+        return model
+
+    def get(self, name: str = "default") -> MobileNetV2ForImageClassification:
+        """
+        The model `name`, loaded if it is not resident. Concurrent requests for
+        the same model wait for a single load, other models stay available.
+        """
+        with self.lock:
+            if name in self.models:
+                self.models.move_to_end(name)
+                return self.models[name]
+
+            future = self.loading.get(name)
+            owner = future is None
+            if owner:
+                future = self.loading[name] = Future()
+
+        if not owner:
+            return future.result()  # Raises if the load failed.
+
+        try:
+            model = self.load(name)
+        except BaseException as e:
+            with self.lock:
+                del self.loading[name]
+            future.set_exception(e)
+            raise
+
+        with self.lock:
+            self.models[name] = model
+            self.sizes[name] = model_bytes(model)
+            del self.loading[name]
+            self._evict()
+        future.set_result(model)
+        return model
+
+    def _evict(self):
+        """Drop least recently used models, but never the one just loaded."""
+        evicted = False
+        while len(self.models) > 1 and (
+            len(self.models) > self.max_models
+            or (self.max_bytes > 0 and sum(self.sizes.values()) > self.max_bytes)
+        ):
+            name, _ = self.models.popitem(last=False)
+            del self.sizes[name]
+            evicted = True
+        if evicted and self.device.startswith("cuda"):
+            import torch
+            torch.cuda.empty_cache()
@@ -0,0 +1,176 @@
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+
+
+@dataclass
+class Judgement:
+    session: str
+    item: int  # Position of the item in the session, ie. "n_seen".
+    target: str  # True label, ie. "0044".
+    human: str  # Label chosen by the annotator.
+    model: str  # Label predicted by the model.
+    model_name: str = "default"  # Which model, see ModelRegistry.
+
+
+class ResultsStore:
+    """
+    Append-only SQLite store of human vs. model judgements across sessions.
+
+    Raw judgements are buffered and written in batches of `flush_size`, the
+    default of 1 commits every judgement so nothing is lost on a crash. In the
+    same transaction the running confusion counts per (source, target,
+    prediction), where the source is "human" or the name of the model, and the
+    per-session totals are incremented, so aggregate statistics are read from
+    tables whose size depends on the number of labels, models and sessions,
+    never on the number of judgements.
+    """
+
+    def __init__(self, path: str, flush_size: int = 1):
+        self.flush_size = flush_size
+        self.buffer: list[Judgement] = []
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS judgements (
+                session TEXT NOT NULL,
+                item INTEGER NOT NULL,
+                target TEXT NOT NULL,
+                human TEXT NOT NULL,
+                model TEXT NOT NULL,
+                model_name TEXT NOT NULL,
+                created REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS confusion (
+                source TEXT NOT NULL,
+                target TEXT NOT NULL,
+                prediction TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (source, target, prediction)
+            );
+            CREATE TABLE IF NOT EXISTS sessions (
+                session TEXT PRIMARY KEY,
+                n INTEGER NOT NULL,
+                human_correct INTEGER NOT NULL,
+                model_correct INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS totals (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+        """)
+        self._migrate()
+        self.conn.commit()
+
+    def _migrate(self):
+        """Upgrade stores written before judgements recorded the model name."""
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(judgements)")]
+        if "model_name" in columns:
+            return
+
+        with self.conn:
+            self.conn.execute(
+                "ALTER TABLE judgements ADD COLUMN model_name TEXT NOT NULL DEFAULT 'default'"
+            )
+            # Model counts were stored under the source "model", which was always the default model.
+            self.conn.execute("""
+                INSERT INTO confusion
+                SELECT 'default', target, prediction, count FROM confusion WHERE source = 'model'
+                ON CONFLICT (source, target, prediction) DO UPDATE SET count = count + excluded.count
+            """)
+            self.conn.execute("DELETE FROM confusion WHERE source = 'model'")
+
+    def add(self, judgement: Judgement):
+        with self.lock:
+            self.buffer.append(judgement)
+            if len(self.buffer) >= self.flush_size:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if len(self.buffer) == 0:
+            return
+
+        try:
+            self._write(self.buffer)
+        finally:  # A failing batch is dropped (the error propagates), it must not block all later writes.
+            self.buffer = []
+
+    def _write(self, buffer: list[Judgement]):
+        created = time.time()
+        confusion: dict[tuple[str, str, str], int] = {}
+        sessions: dict[str, list[int]] = {}
+        for j in buffer:
+            for source, prediction in (("human", j.human), (j.model_name, j.model)):
+                key = (source, j.target, prediction)
+                confusion[key] = confusion.get(key, 0) + 1
+            totals = sessions.setdefault(j.session, [0, 0, 0])
+            totals[0] += 1
+            totals[1] += int(j.human == j.target)
+            totals[2] += int(j.model == j.target)
+
+        n_new_sessions = sum(
+            1 for session in sessions
+            if self.conn.execute("SELECT 1 FROM sessions WHERE session = ?", (session,)).fetchone() is None
+        )
+
+        with self.conn:  # One transaction.
+            self.conn.executemany(
+                # Named columns, migrated stores have model_name last.
+                "INSERT INTO judgements (session, item, target, human, model, model_name, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(j.session, j.item, j.target, j.human, j.model, j.model_name, created) for j in buffer],
+            )
+            self.conn.executemany("""
+                INSERT INTO confusion VALUES (?, ?, ?, ?)
+                ON CONFLICT (source, target, prediction) DO UPDATE SET count = count + excluded.count
+            """, [(*key, count) for key, count in confusion.items()])
+            self.conn.executemany("""
+                INSERT INTO sessions VALUES (?, ?, ?, ?)
+                ON CONFLICT (session) DO UPDATE SET
+                    n = n + excluded.n,
+                    human_correct = human_correct + excluded.human_correct,
+                    model_correct = model_correct + excluded.model_correct
+            """, [(session, *totals) for session, totals in sessions.items()])
+            self.conn.executemany("""
+                INSERT INTO totals VALUES (?, ?)
+                ON CONFLICT (name) DO UPDATE SET value = value + excluded.value
+            """, [("judgements", len(buffer)), ("sessions", n_new_sessions)])
+
+    def session_stats(self, session: str) -> dict:
+        self.flush()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT n, human_correct, model_correct FROM sessions WHERE session = ?", (session,),
+            ).fetchone()
+        n, human_correct, model_correct = row if row is not None else (0, 0, 0)
+        return {"n": n, "human_correct": human_correct, "model_correct": model_correct}
+
+    def stats(self) -> dict:
+        """Aggregates over all sessions, read from the running counts only."""
+        self.flush()
+        with self.lock:
+            totals = dict(self.conn.execute("SELECT name, value FROM totals").fetchall())
+            rows = self.conn.execute("SELECT source, target, prediction, count FROM confusion").fetchall()
+
+        confusion, n, correct = {}, {}, {}
+        for source, target, prediction, count in rows:
+            confusion.setdefault(source, {}).setdefault(target, {})[prediction] = count
+            n[source] = n.get(source, 0) + count
+            correct[source] = correct.get(source, 0) + count * (target == prediction)
+
+        return {
+            "n_sessions": totals.get("sessions", 0),
+            "n_judgements": totals.get("judgements", 0),
+            "accuracy": {source: correct[source] / n[source] for source in n},  # "human" and per model.
+            "confusion": confusion,  # Source -> target -> prediction -> count.
+        }
+
+    def close(self):
+        self.flush()
+        self.conn.close()
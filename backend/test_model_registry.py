@@ -0,0 +1,83 @@
+"""
+cd backend
+
+python -m pytest test_model_registry.py
+
+Runs without torch, models are replaced by stand-ins with a fixed size.
+"""
+from model_registry import ModelRegistry, checkpoint_sort_key
+
+
+class FakeParameter:
+
+    def __init__(self, numel: int):
+        self._numel = numel
+
+    def numel(self) -> int:
+        return self._numel
+
+    def element_size(self) -> int:
+        return 4
+
+
+class FakeModel:
+
+    def __init__(self, name: str, numel: int = 10):
+        self.name = name
+        self._parameters = [FakeParameter(numel)]
+
+    def parameters(self):
+        return iter(self._parameters)
+
+    def buffers(self):
+        return iter([])
+
+
+def make_registry(tmp_path, folders=(), **kwargs) -> ModelRegistry:
+    for folder in folders:
+        (tmp_path / folder).mkdir()
+    registry = ModelRegistry("default-path", models_dir=str(tmp_path), device="cpu", **kwargs)
+    registry.load = lambda name: FakeModel(name)
+    return registry
+
+
+def test_checkpoint_sort_key():
+    names = ["checkpoint-best", "checkpoint-1350", "checkpoint-900", "checkpoint-last"]
+    assert sorted(names, key=checkpoint_sort_key) == [
+        "checkpoint-900", "checkpoint-1350", "checkpoint-best", "checkpoint-last",
+    ]
+
+
+def test_available_mixed_names(tmp_path):
+    registry = make_registry(tmp_path, ["checkpoint-1350", "checkpoint-best", "checkpoint-900", "other"])
+    (tmp_path / "checkpoint-1").write_text("")  # Files are ignored.
+    assert registry.available() == ["default", "checkpoint-900", "checkpoint-1350", "checkpoint-best"]
+
+
+def test_available_without_models_dir():
+    assert ModelRegistry("default-path", device="cpu").available() == ["default"]
+
+
+def test_evict_least_recently_used(tmp_path):
+    registry = make_registry(tmp_path, ["checkpoint-1", "checkpoint-2"], max_models=2)
+    registry.get("default")
+    registry.get("checkpoint-1")
+    registry.get("default")  # "checkpoint-1" is now least recently used.
+    registry.get("checkpoint-2")
+    assert list(registry.resident()) == ["default", "checkpoint-2"]
+
+
+def test_evict_max_bytes_keeps_latest(tmp_path):
+    registry = make_registry(tmp_path, ["checkpoint-1"], max_models=10, max_bytes=50)
+    registry.get("default")  # 40 bytes.
+    registry.get("checkpoint-1")  # 80 bytes in total, over the limit.
+    assert registry.resident() == {"checkpoint-1": 40}
+
+    registry.max_bytes = 10  # A single model over the limit is still kept.
+    registry._evict()
+    assert registry.resident() == {"checkpoint-1": 40}
+
+
+def test_get_returns_resident_model(tmp_path):
+    registry = make_registry(tmp_path)
+    assert registry.get("default") is registry.get("default")
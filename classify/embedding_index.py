@@ -0,0 +1,221 @@
+"""
+Persistent embedding index over all patches for texture retrieval.
+
+The penultimate (pooled) features of the classifier are L2 normalized and
+stored quantized as float16 or int8 rows in a raw, memory-mapped matrix, so
+cosine similarity is a dot product and the index never has to fit into RAM.
+New textures are appended to the end of the files, no rebuild required.
+Per-class feature sums are kept alongside, so class centroids are available
+without touching the matrix.
+
+Files in the index folder:
+    meta.json       dim, dtype, number of rows and class names.
+    embeddings.bin  NxD matrix, float16 or int8.
+    labels.bin      N, int32 class index of each row.
+    scales.bin      N, float32 int8 scale of each row, the max-abs entry over 127.
+    centroids.npy   KxD float32 sum of the normalized features per class.
+"""
+import json
+import os
+from pathlib import Path
+import numpy as np
+
+
+def normalize(x: np.ndarray) -> np.ndarray:
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), 1e-12)
+
+
+class EmbeddingIndex:
+
+    def __init__(self, folder: str, dim: int = 1280, dtype: str = "float16"):
+        """Open the index in `folder`, or create an empty one with `dim` and `dtype` if it does not exist."""
+        assert dtype in ("float16", "int8")
+        self.folder = Path(folder)
+        meta_path = self.folder / "meta.json"
+        if meta_path.exists():
+            meta = json.loads(meta_path.read_text())
+            self.dim = meta["dim"]
+            self.dtype = meta["dtype"]
+            self.count = meta["count"]
+            self.names = meta["names"]
+            self.centroid_sums = np.load(self.folder / "centroids.npy")
+        else:
+            self.folder.mkdir(parents=True, exist_ok=True)
+            self.dim = dim
+            self.dtype = dtype
+            self.count = 0
+            self.names = []
+            self.centroid_sums = np.zeros((0, dim), dtype=np.float32)
+            (self.folder / "embeddings.bin").touch()
+            (self.folder / "labels.bin").touch()
+            (self.folder / "scales.bin").touch()
+            self._write_meta()
+        self._open()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def _write_meta(self):
+        np.save(self.folder / "centroids.npy", self.centroid_sums)
+        meta = {"dim": self.dim, "dtype": self.dtype, "count": self.count, "names": self.names}
+        (self.folder / "meta.json").write_text(json.dumps(meta, indent=2))
+
+    def _open(self):
+        """(Re-)map the files, np.memmap cannot map empty files."""
+        if self.count == 0:
+            self.embeddings = np.zeros((0, self.dim), dtype=self.dtype)
+            self.labels = np.zeros((0,), dtype=np.int32)
+            self.scales = np.zeros((0,), dtype=np.float32)
+            return
+        self.embeddings = np.memmap(
+            self.folder / "embeddings.bin", dtype=self.dtype, mode="r", shape=(self.count, self.dim),
+        )
+        self.labels = np.memmap(
+            self.folder / "labels.bin", dtype=np.int32, mode="r", shape=(self.count,),
+        )
+        self.scales = np.ones((self.count,), dtype=np.float32)
+        if self.dtype == "int8":
+            self.scales = np.memmap(
+                self.folder / "scales.bin", dtype=np.float32, mode="r", shape=(self.count,),
+            )
+
+    def _quantize(self, x: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Quantized rows and their scales, int8 uses the full code range of every row."""
+        if self.dtype == "int8":
+            scales = np.maximum(np.abs(x).max(axis=1), 1e-12).astype(np.float32) / 127
+            return np.clip(np.round(x / scales[:, None]), -127, 127).astype(np.int8), scales
+        return x.astype(np.float16), np.ones((len(x),), dtype=np.float32)
+
+    def _dequantize(self, x: np.ndarray, scales: np.ndarray) -> np.ndarray:
+        x = x.astype(np.float32)
+        if self.dtype == "int8":
+            x *= scales[:, None]
+        return x
+
+    def add(self, embeddings: np.ndarray, names: list[str]):
+        """Append NxD `embeddings` with their class `names` (N,), new class names are registered on the fly."""
+        assert embeddings.shape == (len(names), self.dim)
+        z = normalize(embeddings)
+
+        all_names = list(self.names)
+        name2id = {name: i for i, name in enumerate(all_names)}
+        for name in names:
+            if name not in name2id:
+                name2id[name] = len(all_names)
+                all_names.append(name)
+        labels = np.array([name2id[name] for name in names], dtype=np.int32)
+
+        sums = np.zeros((len(all_names), self.dim), dtype=np.float32)
+        sums[:len(self.centroid_sums)] = self.centroid_sums
+        np.add.at(sums, labels, z)
+
+        # Drop bytes past `count` left by an interrupted add, then append.
+        x, scales = self._quantize(z)
+        files = [("embeddings.bin", x, self.dim * x.itemsize), ("labels.bin", labels, 4)]
+        if self.dtype == "int8":
+            files.append(("scales.bin", scales, 4))
+        for filename, data, row_bytes in files:
+            path = self.folder / filename
+            os.truncate(path, self.count * row_bytes)
+            with open(path, "ab") as f:
+                f.write(data.tobytes())
+
+        # Commit, `count` in meta.json marks the valid rows.
+        self.names = all_names
+        self.centroid_sums = sums
+        self.count += len(labels)
+        self._write_meta()
+        self._open()
+
+    def centroid(self, name: str) -> np.ndarray:
+        """Normalized mean feature (D,) of a class."""
+        return normalize(self.centroid_sums[self.names.index(name)])
+
+    def search(
+        self,
+        queries: np.ndarray,
+        k: int = 10,
+        block_size: int = 65536,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Top-k cosine similarity search for a batch of QxD `queries`, streaming
+        the memory-mapped matrix in blocks of `block_size` rows.
+        Returns the scores and row indices, both Qxk in descending order.
+        """
+        q = normalize(np.atleast_2d(queries))  # QxD
+        k = min(k, self.count)
+        best_scores = np.full((len(q), 0), -np.inf, dtype=np.float32)
+        best_indices = np.zeros((len(q), 0), dtype=np.int64)
+
+        for start in range(0, self.count, block_size):
+            block = self._dequantize(
+                self.embeddings[start:start+block_size], self.scales[start:start+block_size],
+            )  # BxD
+            scores = q @ block.T  # QxB
+            scores = np.concatenate([best_scores, scores], axis=1)
+            indices = np.concatenate([
+                best_indices,
+                np.broadcast_to(np.arange(start, start + len(block)), (len(q), len(block))),
+            ], axis=1)
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            best_scores = np.take_along_axis(scores, top, axis=1)
+            best_indices = np.take_along_axis(indices, top, axis=1)
+
+        order = np.argsort(-best_scores, axis=1)
+        return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_indices, order, axis=1)
+
+    def search_class(self, name: str, k: int = 10) -> tuple[np.ndarray, np.ndarray]:
+        """Top-k rows closest to the centroid of class `name`."""
+        scores, indices = self.search(self.centroid(name)[None], k)
+        return scores[0], indices[0]
+
+    def similar_classes(self, name: str, k: int = 10) -> list[tuple[str, float]]:
+        """The k classes with the most similar centroids to `name`, ie. the textures that look most like it."""
+        centroids = normalize(self.centroid_sums)  # KxD
+        scores = centroids @ self.centroid(name)  # K,
+        i = self.names.index(name)
+        order = [j for j in np.argsort(-scores) if j != i][:k]
+        return [(self.names[j], float(scores[j])) for j in order]
+
+
+if __name__ == "__main__":
+    import sys
+    sys.path.append(".")
+
+    from classify.linear_probe import *
+
+    root = r"C:\Users\lbrunn\projects\surface-inspection\datasets\wood"
+    size = 128
+    mean = 0.5
+    std = 0.5
+    pretrained_model_name_or_path = r"C:\Users\lbrunn\projects\surface-inspection\classify\logs\checkpoint-1350"
+    index_dir = r"C:\Users\lbrunn\projects\surface-inspection\classify\index\checkpoint-1350"
+    dtype = "float16"
+
+    test_transforms = Transforms(Compose([
+        CenterCrop(size),
+        ToTensor(),
+        Normalize(mean, std),
+    ]))
+
+    model: MobileNetV2ForImageClassification = AutoModelForImageClassification.from_pretrained(
+        pretrained_model_name_or_path,
+    ).eval()
+    index = EmbeddingIndex(index_dir, dim=model.classifier.in_features, dtype=dtype)
+
+    ds = load_dataset("imagefolder", data_dir=root, split="train")
+    names = ds.features["label"].names
+    missing = [i for i, name in enumerate(names) if name not in index.names]  # Only add new textures.
+
+    if len(missing) > 0:
+        ds = ds.filter(lambda label: label in missing, input_columns="label")
+        ds = ds.with_transform(test_transforms.apply_transforms)
+        z, y = extract_embeddings(model, ds)
+        index.add(z, [names[i] for i in y])
+
+    start = time.perf_counter()
+    print("Most similar to 0044:", index.similar_classes("0044"))
+    scores, indices = index.search_class("0044", k=10)
+    print("Closest patches:", [index.names[index.labels[i]] for i in indices], scores)
+    print(f"Queries took {1000 * (time.perf_counter() - start):.2f}ms")
@@ -0,0 +1,232 @@
+"""
+Fast retraining of the classification head on cached backbone embeddings.
+
+The frozen MobileNetV2 backbone of a fine-tuned checkpoint is run once over
+the dataset and the pooled embeddings are cached on disk, one file per class
+and split. Only new classes and classes whose patch files changed are
+extracted, so adding or updating a texture only costs a forward pass over its
+own patches. The linear head is
+then trained on the embeddings in seconds and the result is exported as a
+regular checkpoint which the backend can load with `from_pretrained`.
+"""
+import sys
+sys.path.append(".")
+
+import hashlib
+import json
+from pathlib import Path
+from torch.utils.data import DataLoader
+from transformers.models.mobilenet_v2 import MobileNetV2ForImageClassification
+from tqdm import tqdm
+
+from classify.train import *
+
+
+@torch.inference_mode()
+def extract_embeddings(
+    model: MobileNetV2ForImageClassification,
+    ds,
+    batch_size: int = 256,
+    num_workers: int = 0,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Pooled backbone embeddings (NxD; float32) and integer labels (N,) of a transformed dataset."""
+    device = next(model.parameters()).device
+    dl = DataLoader(ds, batch_size=batch_size, num_workers=num_workers)
+
+    embeddings, labels = [], []
+    for batch in tqdm(dl, desc="Extracting embeddings..."):
+        x = batch["pixel_values"].to(device)  # BxCxHxW
+        z = model.mobilenet_v2(x).pooler_output  # BxD
+        embeddings.append(z.float().cpu().numpy())
+        labels.append(batch["label"].numpy())
+
+    if len(embeddings) == 0:
+        return np.zeros((0, model.classifier.in_features), dtype=np.float32), np.zeros((0,), dtype=np.int64)
+    return np.concatenate(embeddings, axis=0), np.concatenate(labels, axis=0)
+
+
+def class_fingerprint(folder: Path) -> dict:
+    """Number of files, latest modification time and a hash of the file names of a class folder."""
+    files = sorted(p for p in folder.iterdir() if p.is_file()) if folder.exists() else []
+    return {
+        "n_files": len(files),
+        "max_mtime": max((p.stat().st_mtime for p in files), default=0.0),
+        "names_hash": hashlib.sha1("\n".join(p.name for p in files).encode()).hexdigest(),
+    }
+
+
+def backbone_fingerprint(model: MobileNetV2ForImageClassification) -> dict:
+    """Checkpoint path and a hash of the backbone weights which produce the embeddings."""
+    sha1 = hashlib.sha1()
+    for key, tensor in model.mobilenet_v2.state_dict().items():
+        sha1.update(key.encode())
+        sha1.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+    return {
+        "name_or_path": model.config.name_or_path,
+        "weights_hash": sha1.hexdigest(),
+    }
+
+
+def is_cached(cache_dir: Path, name: str, fingerprint: dict) -> bool:
+    npy_path = cache_dir / f"{name}.npy"
+    json_path = cache_dir / f"{name}.json"
+    if not npy_path.exists() or not json_path.exists():
+        return False
+    return json.loads(json_path.read_text()) == fingerprint
+
+
+def cached_embeddings(
+    model: MobileNetV2ForImageClassification,
+    ds,
+    transforms: Transforms,
+    data_dir: Path,
+    cache_dir: Path,
+    batch_size: int = 256,
+    num_workers: int = 0,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Embeddings and labels of all classes in the (untransformed) `ds` of the
+    imagefolder split `data_dir`, cached in `cache_dir` as "<label name>.npy".
+    A class is (re-)extracted if it is not cached yet or if its fingerprint,
+    stored as "<label name>.json", changed. The fingerprint covers the class
+    folder and the backbone, so switching checkpoints never reuses embeddings.
+    """
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    names = ds.features["label"].names
+    backbone = backbone_fingerprint(model)
+    fingerprints = [{**class_fingerprint(data_dir / name), **backbone} for name in names]
+    missing = [i for i, name in enumerate(names) if not is_cached(cache_dir, name, fingerprints[i])]
+
+    if len(missing) > 0:
+        missing_ds = ds.filter(lambda label: label in missing, input_columns="label")
+        missing_ds = missing_ds.with_transform(transforms.apply_transforms)
+        z, y = extract_embeddings(model, missing_ds, batch_size, num_workers)
+        for i in missing:
+            np.save(cache_dir / f"{names[i]}.npy", z[y == i])
+            (cache_dir / f"{names[i]}.json").write_text(json.dumps(fingerprints[i]))  # After the embeddings.
+
+    embeddings, labels = [], []
+    for i, name in enumerate(names):
+        z = np.load(cache_dir / f"{name}.npy")
+        embeddings.append(z)
+        labels.append(np.full((len(z),), i, dtype=np.int64))
+    return np.concatenate(embeddings, axis=0), np.concatenate(labels, axis=0)
+
+
+def init_head(
+    model: MobileNetV2ForImageClassification,
+    labels: list[str],
+) -> torch.nn.Linear:
+    """
+    New linear head for `labels`, rows of classes already known
+    by the model are copied over so training starts from the old head.
+    """
+    old = model.classifier
+    head = torch.nn.Linear(old.in_features, len(labels))
+    old_label2id = model.config.label2id
+    with torch.no_grad():
+        for i, label in enumerate(labels):
+            if label in old_label2id:
+                j = int(old_label2id[label])
+                head.weight[i] = old.weight[j]
+                head.bias[i] = old.bias[j]
+    return head
+
+
+def train_head(
+    head: torch.nn.Linear,
+    embeddings: np.ndarray,
+    labels: np.ndarray,
+    learning_rate: float = 1e-3,
+    num_train_epochs: int = 100,
+    batch_size: int = 1024,
+    label_smoothing: float = 0.1,
+    seed: int = 42,
+) -> torch.nn.Linear:
+    """Train the linear head with cross entropy on the (CPU resident) embeddings."""
+    generator = torch.Generator().manual_seed(seed)
+    z = torch.from_numpy(embeddings)  # NxD
+    y = torch.from_numpy(labels)  # N,
+    n = len(z)
+
+    optimizer = torch.optim.AdamW(head.parameters(), lr=learning_rate)
+    criterion = torch.nn.CrossEntropyLoss(label_smoothing=label_smoothing)
+
+    head.train()
+    for epoch in range(num_train_epochs):
+        perm = torch.randperm(n, generator=generator)
+        for k in range(0, n, batch_size):
+            idx = perm[k:k+batch_size]
+            loss = criterion(head(z[idx]), y[idx])
+            optimizer.zero_grad(set_to_none=True)
+            loss.backward()
+            optimizer.step()
+    return head.eval()
+
+
+@torch.inference_mode()
+def head_accuracy(head: torch.nn.Linear, embeddings: np.ndarray, labels: np.ndarray) -> float:
+    preds = torch.argmax(head(torch.from_numpy(embeddings)), dim=1).numpy()
+    return float((preds == labels).mean())
+
+
+def export_checkpoint(
+    model: MobileNetV2ForImageClassification,
+    head: torch.nn.Linear,
+    labels: list[str],
+    output_dir: str,
+):
+    """Replace the classifier of `model` by `head` and save it as a loadable checkpoint."""
+    label2id, id2label = dict(), dict()
+    for i, label in enumerate(labels):
+        label2id[label] = str(i)
+        id2label[str(i)] = label
+
+    model.classifier = head.to(next(model.parameters()).device)
+    model.num_labels = len(labels)
+    model.config.num_labels = len(labels)
+    model.config.label2id = label2id
+    model.config.id2label = id2label
+    model.save_pretrained(output_dir)
+
+
+if __name__ == "__main__":
+    root = Path(r"C:\Users\lbrunn\projects\surface-inspection\datasets\wood")
+    size = 128
+    mean = 0.5
+    std = 0.5
+    pretrained_model_name_or_path = r"C:\Users\lbrunn\projects\surface-inspection\classify\logs\checkpoint-1350"
+    cache_dir = Path(r"C:\Users\lbrunn\projects\surface-inspection\classify\embeddings\checkpoint-1350")
+    output_dir = r"C:\Users\lbrunn\projects\surface-inspection\classify\logs\linear-probe"
+    learning_rate = 1e-3
+    num_train_epochs = 100
+    seed = 42
+
+    test_transforms = Transforms(Compose([
+        CenterCrop(size),
+        ToTensor(),
+        Normalize(mean, std),
+    ]))
+
+    loaded = load_dataset("imagefolder", data_dir=str(root))
+    train_ds = loaded["train"]
+    test_ds = loaded["test"]
+    labels = train_ds.features["label"].names
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model: MobileNetV2ForImageClassification = AutoModelForImageClassification.from_pretrained(
+        pretrained_model_name_or_path,
+    ).eval().to(device)
+
+    train_z, train_y = cached_embeddings(model, train_ds, test_transforms, root / "train", cache_dir / "train")
+    test_z, test_y = cached_embeddings(model, test_ds, test_transforms, root / "test", cache_dir / "test")
+
+    start = time.perf_counter()
+    head = init_head(model, labels)
+    head = train_head(head, train_z, train_y, learning_rate, num_train_epochs, seed=seed)
+    print(f"Trained head in {time.perf_counter() - start:.2f}s")
+
+    print("Train accuracy:", head_accuracy(head, train_z, train_y))
+    print("Test accuracy:", head_accuracy(head, test_z, test_y))
+
+    export_checkpoint(model, head, labels, output_dir)
@@ -10,14 +10,107 @@ import matplotlib.pyplot as plt
 from tqdm import tqdm
 from torchmetrics.image.fid import FrechetInceptionDistance
 from torchvision.transforms import PILToTensor
+from transformers.models.mobilenet_v2 import MobileNetV2ForImageClassification
+from scipy.stats import spearmanr
+from abc import ABC, abstractmethod
 import random
+import time
 
 from classify.train import *
 
 
+class FeatureExtractor(ABC):
+    """Maps a batch of BxCxHxW uint8 images to BxD features for the Frechet distance."""
+
+    @abstractmethod
+    def __call__(self, imgs: torch.Tensor) -> torch.Tensor:
+        ...
+
+
+class InceptionFeatures(FeatureExtractor):
+    """The InceptionV3 network of the torchmetrics FID, pool features (2048)."""
+
+    def __init__(self, size: int, device: str = "cuda"):
+        self.inception = FrechetInceptionDistance().inception.to(device)
+        self.inception.INPUT_IMAGE_SIZE = size
+        self.device = device
+
+    @torch.inference_mode()
+    def __call__(self, imgs: torch.Tensor) -> torch.Tensor:
+        return self.inception(imgs.to(self.device)).double().cpu()
+
+
+class MobileNetFeatures(FeatureExtractor):
+    """
+    Pooled backbone features (1280) of the fine-tuned MobileNetV2 classifier,
+    much lighter than InceptionV3 and fast enough for the CPU.
+    """
+
+    def __init__(
+        self,
+        pretrained_model_name_or_path: str,
+        size: int,
+        mean: float = 0.5,
+        std: float = 0.5,
+        device: str = "cpu",
+    ):
+        self.model: MobileNetV2ForImageClassification = AutoModelForImageClassification.from_pretrained(
+            pretrained_model_name_or_path,
+        ).eval().to(device, memory_format=torch.channels_last)
+        self.transforms = Compose([CenterCrop(size), Normalize(mean, std)])  # Batched test transforms.
+        self.device = device
+
+    @torch.inference_mode()
+    def __call__(self, imgs: torch.Tensor) -> torch.Tensor:
+        x = self.transforms(imgs.to(self.device).float() / 255)  # BxCxHxW
+        x = x.contiguous(memory_format=torch.channels_last)
+        return self.model.mobilenet_v2(x).pooler_output.double().cpu()
+
+
+def extract_features(extractor: FeatureExtractor, images: torch.Tensor, batch_size: int = 256) -> torch.Tensor:
+    features = []
+    for k in tqdm(range(0, len(images), batch_size), desc="Extracting features..."):
+        features.append(extractor(images[k:k+batch_size]))
+    return torch.cat(features, dim=0)  # NxD
+
+
+def class_statistics(features: torch.Tensor, labels: torch.Tensor, classes: torch.Tensor) -> list:
+    """Mean and covariance of the features of each class, computed once and reused for all pairs."""
+    stats = []
+    for c in classes:
+        x = features[labels == c].numpy()
+        stats.append((x.mean(axis=0), np.cov(x, rowvar=False)))
+    return stats
+
+
+def frechet_distance(mu1: np.ndarray, sigma1: np.ndarray, mu2: np.ndarray, sigma2: np.ndarray) -> float:
+    """|mu1 - mu2|^2 + tr(sigma1 + sigma2 - 2 sqrt(sigma1 sigma2)), the trace of the root via eigenvalues."""
+    eigvals = np.linalg.eigvals(sigma1 @ sigma2).real.clip(min=0)
+    return float(((mu1 - mu2) ** 2).sum() + np.trace(sigma1) + np.trace(sigma2) - 2 * np.sqrt(eigvals).sum())
+
+
+def fid_scores(stats: list, i: int) -> np.ndarray:
+    """Frechet distances of class i to all other classes, in class order without i."""
+    mu, sigma = stats[i]
+    return np.array([frechet_distance(mu, sigma, *stats[j]) for j in range(len(stats)) if j != i])
+
+
+def ranking_agreement(scores1: np.ndarray, scores2: np.ndarray, topk: int) -> dict:
+    """Spearman rank correlation and top-k overlap of two score vectors over the same classes."""
+    top1 = set(np.argsort(scores1)[:topk])
+    top2 = set(np.argsort(scores2)[:topk])
+    return {
+        "spearman": float(spearmanr(scores1, scores2)[0]),
+        f"top{topk}_overlap": len(top1 & top2) / topk,
+    }
+
+
 if __name__ == "__main__":
     root = r"C:\Users\lbrunn\projects\surface-inspection\datasets\wood"
     size = 128
+    pretrained_model_name_or_path = r"C:\Users\lbrunn\projects\surface-inspection\classify\logs\checkpoint-1350"
+    feature_extractor = "mobilenet"  # "mobilenet" (CPU) or "inception" (GPU).
+    compare = False  # Also run the other extractor and report the agreement of the rankings.
 
     fid_transforms = Transforms(Compose([
         CenterCrop(size),
@@ -52,33 +145,29 @@ if __name__ == "__main__":
     names = [id2label[str(label.item())] for label in classes]
     N = len(classes)
 
-    fid = FrechetInceptionDistance().cuda()
-    fid.set_dtype(torch.float32)
-    fid.inception.INPUT_IMAGE_SIZE = size
+    extractors = {
+        "mobilenet": lambda: MobileNetFeatures(pretrained_model_name_or_path, size),
+        "inception": lambda: InceptionFeatures(size),
+    }
 
     name = "0044"
     i = names.index(name)
     topk = 10
 
-    fid_scores = []
-    fid.reset_real_features = False
-    imgs = images[labels == classes[i]].cuda()  # BxCxHxW; uint8
-    fid.update(imgs=imgs, real=True)
+    start = time.perf_counter()
+    features = extract_features(extractors[feature_extractor](), images)
+    scores = fid_scores(class_statistics(features, labels, classes), i)
+    print(f"{feature_extractor} took {time.perf_counter() - start:.2f}s")
 
-    for j in range(N):
-        if i == j:  # Skip.
-            continue
+    if compare:
+        other = "inception" if feature_extractor == "mobilenet" else "mobilenet"
+        other_features = extract_features(extractors[other](), images)
+        other_scores = fid_scores(class_statistics(other_features, labels, classes), i)
+        print(f"Agreement of {feature_extractor} with {other}:", ranking_agreement(scores, other_scores, topk))
 
-        imgs = images[labels == classes[j]].cuda()
-        fid.update(imgs=imgs, real=False)
-        fid_score = fid.compute().cpu().numpy()
-        fid.reset()
-        fid_scores.append(fid_score)
-    
-    fid_scores = np.stack(fid_scores)
-    indices = np.argsort(fid_scores)  # Ascending order.
-    ids = np.array([j for j in range(N)])[indices[:topk]]
-    topk_names = [id2label[str(classes[i].item())] for i in ids]
+    indices = np.argsort(scores)  # Ascending order.
+    ids = np.array([j for j in range(N) if j != i])[indices[:topk]]
+    topk_names = [id2label[str(classes[j].item())] for j in ids]
 
     print("Real:", id2label[str(classes[i].item())])
     print("Fakes:", topk_names)
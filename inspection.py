@@ -0,0 +1,203 @@
+"""
+Sliding-window inspection of full surface images.
+
+The classifier is trained on the patches produced by `post_simulation.tile`,
+here an arbitrary sized image is covered with (possibly overlapping) windows
+of the same size. The last row and column of windows are aligned to the far
+edges, so every pixel is inspected even if the image size is not a multiple
+of the stride. The windows are zero-copy strided views into the image and
+are only materialized batch by batch, so a 4k image can be inspected within
+a bounded memory budget.
+
+python inspection.py image.png --checkpoint path/to/checkpoint-1350 --stride 64 --heatmap heatmap.png
+"""
+import argparse
+from dataclasses import dataclass
+import numpy as np
+import torch
+from PIL import Image
+from torchvision.transforms import (
+    CenterCrop,
+    Compose,
+    Normalize,
+)
+from transformers import AutoModelForImageClassification
+from transformers.models.mobilenet_v2 import MobileNetV2ForImageClassification
+
+from post_simulation import write_image
+
+
+@dataclass
+class InspectionResult:
+    labels: np.ndarray  # RxC; int, predicted label per window.
+    confidences: np.ndarray  # RxC; float, softmax probability of the predicted label.
+    row_starts: np.ndarray  # R; top pixel row of each window row.
+    col_starts: np.ndarray  # C; left pixel column of each window column.
+    window_size: int
+    stride: int
+    label: int  # Image-level verdict, the majority label over all windows.
+    confidence: float  # Mean confidence of the windows voting for `label`.
+    agreement: float  # Fraction of windows voting for `label`.
+
+
+def window_starts(length: int, window_size: int, stride: int) -> np.ndarray:
+    """Window offsets every `stride` pixels, plus one aligned to the far edge if the strides do not reach it."""
+    starts = np.arange(0, length - window_size + 1, stride)
+    if starts[-1] != length - window_size:
+        starts = np.append(starts, length - window_size)
+    return starts
+
+
+def sliding_windows(image: np.ndarray, window_size: int) -> np.ndarray:
+    """
+    Zero-copy view of the windows at every offset of an HxWxC image, shape
+    (H-w+1)x(W-w+1)xwxwxC, index it with `window_starts` to get the inspected ones.
+    """
+    height, width, _ = image.shape
+    assert height >= window_size and width >= window_size
+
+    windows = np.lib.stride_tricks.sliding_window_view(
+        image, (window_size, window_size), axis=(0, 1),
+    )  # (H-w+1)x(W-w+1)xCxwxw
+    return windows.transpose(0, 1, 3, 4, 2)  # (H-w+1)x(W-w+1)xwxwxC; still a view.
+
+
+def batch_transforms(size: int, mean: float, std: float) -> Compose:
+    """Batched equivalent of the `test_transforms` for BxCxHxW float tensors in [0, 1]."""
+    return Compose([
+        CenterCrop(size),
+        Normalize(mean, std),
+    ])
+
+
+def to_tensor(windows: np.ndarray) -> torch.Tensor:
+    """Batched `ToTensor`, BxHxWxC uint8 windows to a BxCxHxW float tensor in [0, 1]."""
+    x = torch.from_numpy(np.ascontiguousarray(windows))
+    return x.permute(0, 3, 1, 2).float().div_(255)
+
+
+@torch.inference_mode()
+def inspect(
+    image: np.ndarray,
+    model: MobileNetV2ForImageClassification,
+    transforms: Compose,
+    window_size: int = 128,
+    stride: int = 128,
+    batch_size: int = 256,
+    max_batch_bytes: int = 256 * 1024**2,
+) -> InspectionResult:
+    """
+    Classify all windows of an HxWx3 uint8 RGB image in batches, convert other
+    modes with PIL first (`Image.open(...).convert("RGB")`). The batch size is
+    capped such that a batch of input tensors stays below `max_batch_bytes`.
+    """
+    assert image.ndim == 3 and image.shape[-1] == 3, "Expected an HxWx3 RGB image."
+
+    windows = sliding_windows(image, window_size)
+    row_starts = window_starts(image.shape[0], window_size, stride)
+    col_starts = window_starts(image.shape[1], window_size, stride)
+    n_rows, n_cols = len(row_starts), len(col_starts)
+    n_windows = n_rows * n_cols
+
+    bytes_per_window = 3 * window_size * window_size * 4  # float32
+    batch_size = max(1, min(batch_size, max_batch_bytes // bytes_per_window))
+
+    device = next(model.parameters()).device
+    dtype = next(model.parameters()).dtype
+    labels, confidences = [], []
+    for k in range(0, n_windows, batch_size):
+        idx = np.arange(k, min(k + batch_size, n_windows))
+        batch = windows[row_starts[idx // n_cols], col_starts[idx % n_cols]]  # BxHxWxC; copies only this batch.
+        x = transforms(to_tensor(batch))  # BxCxHxW
+        x = x.to(device=device, dtype=dtype)
+        probs = torch.softmax(model(x).logits.float(), dim=1)  # BxK
+        confidence, label = probs.max(dim=1)  # B,
+        labels.append(label.cpu().numpy())
+        confidences.append(confidence.cpu().numpy())
+
+    labels = np.concatenate(labels).reshape(n_rows, n_cols)
+    confidences = np.concatenate(confidences).reshape(n_rows, n_cols)
+
+    votes = np.bincount(labels.ravel())
+    label = int(np.argmax(votes))
+    mask = labels == label
+
+    return InspectionResult(
+        labels=labels,
+        confidences=confidences,
+        row_starts=row_starts,
+        col_starts=col_starts,
+        window_size=window_size,
+        stride=stride,
+        label=label,
+        confidence=float(confidences[mask].mean()),
+        agreement=float(mask.mean()),
+    )
+
+
+def heatmap(result: InspectionResult, height: int, width: int) -> np.ndarray:
+    """
+    HxW map in [0, 1] of the mean confidence in the image-level verdict over all
+    windows covering a pixel. Windows voting for another label contribute 0,
+    so low values mark regions which do not look like the rest of the image.
+    Pixels not covered by any window would be NaN, but with the edge-aligned
+    windows of `inspect` every pixel is covered.
+    """
+    support = np.where(result.labels == result.label, result.confidences, 0.0)
+    accum = np.zeros((height, width), dtype=np.float32)
+    count = np.zeros((height, width), dtype=np.float32)
+
+    w = result.window_size
+    for r, y in enumerate(result.row_starts):
+        for c, x in enumerate(result.col_starts):
+            accum[y:y+w, x:x+w] += support[r, c]
+            count[y:y+w, x:x+w] += 1
+
+    return np.divide(accum, count, out=np.full_like(accum, np.nan), where=count > 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sliding-window inspection of a full surface image.")
+    parser.add_argument("image", help="Path to the image to inspect.")
+    parser.add_argument("--checkpoint", required=True, help="Fine-tuned classifier checkpoint.")
+    parser.add_argument("--window-size", type=int, default=128)
+    parser.add_argument("--stride", type=int, default=128)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--max-batch-mb", type=int, default=256)
+    parser.add_argument("--mean", type=float, default=0.5)
+    parser.add_argument("--std", type=float, default=0.5)
+    parser.add_argument("--heatmap", default=None, help="Optional path to write the heatmap as PNG.")
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model: MobileNetV2ForImageClassification = AutoModelForImageClassification.from_pretrained(
+        args.checkpoint,
+    ).eval().to(device)
+    transforms = batch_transforms(args.window_size, args.mean, args.std)
+
+    image = np.array(Image.open(args.image).convert("RGB"))  # Same as the test transforms.
+    result = inspect(
+        image,
+        model,
+        transforms,
+        window_size=args.window_size,
+        stride=args.stride,
+        batch_size=args.batch_size,
+        max_batch_bytes=args.max_batch_mb * 1024**2,
+    )
+
+    id2label = model.config.id2label
+    print("Label:", id2label[result.label])
+    print(f"Confidence: {result.confidence:.4f}")
+    print(f"Agreement: {result.agreement:.4f} over {result.labels.size} windows")
+
+    if args.heatmap is not None:
+        hm = heatmap(result, image.shape[0], image.shape[1])
+        covered = ~np.isnan(hm)
+        gray = (255 * np.nan_to_num(hm)).astype(np.uint8)
+        alpha = (255 * covered).astype(np.uint8)  # Uncovered border pixels are transparent.
+        write_image(args.heatmap, np.stack([gray, alpha], axis=-1))  # HxWx2; grayscale with alpha.
+
+
+if __name__ == "__main__":
+    main()
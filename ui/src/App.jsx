@@ -79,9 +79,23 @@ export default function App() {
   const fetchEvaluation = async () => {
     setLoading(true); // Start loading
     try {
-      const response = await fetch("http://localhost:5000/api/evaluation");
-      const data = await response.json();
-      setEvalResult({...data});
+      // Start the evaluation job, then poll until it is done.
+      const response = await fetch("http://localhost:5000/api/evaluation", { method: "POST" });
+      const { job_id } = await response.json();
+      const pollInterval = 500;  // [ms]
+
+      while (true) {
+        const pollResponse = await fetch(`http://localhost:5000/api/evaluation/${job_id}`);
+        const data = await pollResponse.json();
+        if (data.status === "done") {
+          setEvalResult({...data});
+          break;
+        }
+        if (data.status === "failed" || data.status === "unknown") {
+          throw new Error(data.error || `Evaluation job ${data.status}`);
+        }
+        await new Promise((resolve) => setTimeout(resolve, pollInterval));
+      }
     } catch (error) {
       console.error("Error fetching evaluation:", error);
     }
@@ -111,6 +125,12 @@ export default function App() {
 
     if (droppedImages.has(identifier)) return;  // Prevent re-dropping
 
+    fetch("http://localhost:5000/api/judgement", {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ n_seen: identifier, label: side === "left" ? leftLabel : rightLabel }),
+    }).catch((error) => console.error("Error posting judgement:", error));
+
     if (side === "left") {
       setLeftImages([imageData, ...leftImages]);
       if (label == leftLabel) setNumCorrect(numCorrect + 1);